@@ -2,7 +2,7 @@
 
 # TODO rip out all the explicit clipboard stuff and move it into a go cli/service that this will use instead.
 import tkinter as tk
-from tkinter import Listbox, Scrollbar, Button, Entry, Toplevel, PhotoImage, Text, messagebox
+from tkinter import Listbox, Scrollbar, Button, Entry, Toplevel, PhotoImage, Text, messagebox, filedialog
 from tkinter.scrolledtext import ScrolledText
 import pyperclip
 import threading
@@ -12,6 +12,7 @@ import os
 import json
 import logging
 import queue
+from clipsync import SyncReplica, SyncError, DirectoryTransport, item_digest, sync
 # TODO create a script to install Linux dependencies for Linux
 from pygments import highlight, styles
 from pygments.lexers import JsonLexer, PythonLexer, CLexer
@@ -111,6 +112,8 @@ class ClipboardManager:
         clipboard_list: Full list of ClipboardItem objects.
         filtered_list: Filtered list based on search query.
         last_clipboard_data: The most recent clipboard content to avoid duplicates.
+        sync_replica: SyncReplica tracking history changes for sync with other instances.
+        sync_dir: Shared directory used for sync, or None if not configured.
     """
     
     def __init__(self, master):
@@ -182,8 +185,11 @@ class ClipboardManager:
         self.rename_button.pack(side=tk.BOTTOM, fill=tk.X)
         self.remove_button = Button(master, text="Remove", command=self.remove_from_clipboard, bg=self.button_bg_color, fg=self.fg_color)
         self.remove_button.pack(side=tk.BOTTOM, fill=tk.X)
+        self.sync_button = Button(master, text="Sync", command=self.sync_history, bg=self.button_bg_color, fg=self.fg_color)
+        self.sync_button.pack(side=tk.BOTTOM, fill=tk.X)
 
         self.load_clipboard_list()
+        self.load_sync_state()
 
         try:
             logger.info("Starting clipboard monitoring thread")
@@ -417,6 +423,108 @@ class ClipboardManager:
             logger.info("Clipboard history saved successfully")
         except (pickle.PickleError, OSError) as e:
             logger.error("Failed to save clipboard history: %s", e, exc_info=True)
+        self.save_sync_state()
+
+    def load_sync_state(self):
+        """Load the sync state from 'clipboard_sync.json' if it exists.
+
+        Starts a new replica if the file is missing or cannot be read. Local
+        history that is not yet known to the replica is recorded as changes.
+        """
+        self.sync_replica = None
+        self.sync_dir = None
+        if os.path.exists("clipboard_sync.json"):
+            try:
+                with open("clipboard_sync.json", "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.sync_replica = SyncReplica.from_dict(data['replica'])
+                sync_dir = data.get('sync_dir')
+                self.sync_dir = sync_dir if isinstance(sync_dir, str) else None
+                logger.info("Loaded sync state (replica %s)", self.sync_replica.replica_id)
+            except (OSError, ValueError, KeyError, TypeError, SyncError) as e:
+                logger.error("Failed to load sync state: %s", e, exc_info=True)
+        if self.sync_replica is None:
+            self.sync_replica = SyncReplica()
+            logger.info("Starting new sync replica %s", self.sync_replica.replica_id)
+        self.sync_replica.record_local(self.clipboard_list)
+
+    def save_sync_state(self):
+        """Record local history changes and save the sync state to 'clipboard_sync.json'."""
+        try:
+            self.sync_replica.record_local(self.clipboard_list)
+            with open("clipboard_sync.json", "w", encoding="utf-8") as f:
+                json.dump({'replica': self.sync_replica.to_dict(), 'sync_dir': self.sync_dir}, f)
+            logger.debug("Sync state saved")
+        except OSError as e:
+            logger.error("Failed to save sync state: %s", e, exc_info=True)
+
+    def sync_history(self):
+        """Sync clipboard history with other Clipman instances through a shared directory.
+
+        Prompts for the shared directory on first use. Only changes are exchanged:
+        new and removed items, pins and names. Item text is copied only for items
+        this instance does not have yet. If the directory is missing or the sync
+        fails, offers to choose a different directory.
+        """
+        if not self.sync_dir and not self.choose_sync_dir():
+            logger.warning("Sync requested but no sync directory chosen")
+            return
+
+        self.sync_replica.record_local(self.clipboard_list)
+        try:
+            # Changes are applied to the history before sending, so a failed push
+            # cannot leave the history behind the replica
+            sync(self.sync_replica, DirectoryTransport(self.sync_dir), on_change=self._apply_sync_changes)
+        except (OSError, SyncError) as e:
+            logger.error("Sync failed: %s", e, exc_info=True)
+            self.save_clipboard_list()
+            winsound.MessageBeep(winsound.MB_ICONHAND)
+            if messagebox.askyesno("Error", f"Sync failed: {e}\n\nChoose a different sync directory?"):
+                if self.choose_sync_dir():
+                    self.sync_history()
+            return
+
+        self.save_clipboard_list()
+
+    def choose_sync_dir(self):
+        """Prompt the user for the shared sync directory.
+
+        Returns:
+            True if a directory was chosen, False if the dialog was cancelled.
+        """
+        sync_dir = filedialog.askdirectory(title="Choose a shared sync directory", initialdir=self.sync_dir)
+        if not sync_dir:
+            return False
+        self.sync_dir = sync_dir
+        logger.info("Sync directory set to %s", self.sync_dir)
+        self.save_sync_state()
+        return True
+
+    def _apply_sync_changes(self, changed):
+        """Update the local history with items changed by a sync.
+
+        Args:
+            changed: Digests of changed items, ordered by when they were added.
+        """
+        items_by_digest = {item_digest(item.text): item for item in self.clipboard_list}
+        for digest in changed:
+            item = items_by_digest.get(digest)
+            entry = self.sync_replica.entry(digest)
+            if entry is None:
+                if item is not None:
+                    self.clipboard_list.remove(item)
+                    # Keep the monitoring thread from re-adding it if it is still on the clipboard
+                    self.last_clipboard_data = item.text
+            elif item is None:
+                text = self.sync_replica.body(digest)
+                if text is None:
+                    logger.warning("Body of synced item %s not available yet", digest)
+                    continue
+                self.clipboard_list.append(ClipboardItem(text, *entry))
+            else:
+                item.pinned, item.name = entry
+        self.filter_list(None)
+        logger.info("Applied %s synced change(s). Total items: %s", len(changed), len(self.clipboard_list))
 
     def on_closing(self):
         """Handle application shutdown.
@@ -0,0 +1,722 @@
+# File: clipsync.py
+
+"""Delta-based history sync between Clipman instances.
+
+Each Clipman instance is a replica with its own id. Local history changes are
+turned into small operations (an item appearing or disappearing, a pin toggle,
+a rename) keyed by the SHA-256 digest of the item text. Every operation is
+stamped with a Lamport clock; on conflict the highest (clock, replica id)
+stamp wins, so replicas converge regardless of the order they sync in.
+
+Replicas track a vector clock (highest clock seen per origin replica) and only
+exchange operations the other side has not seen. Item bodies never travel
+with the operations: they are fetched by digest, and only for items the
+receiving side does not already hold.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Item fields that are synced. Each (digest, field) pair is a last-writer-wins register.
+FIELDS = ('present', 'pinned', 'name')
+
+# Replica ids and digests are used as path parts by DirectoryTransport, so they
+# are restricted to lowercase hex.
+_REPLICA_ID_RE = re.compile(r'[0-9a-f]{1,64}')
+_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+
+# DirectoryTransport writes one batch file per push and folds them into one base
+# file per origin once there are at least this many batches and they are at least
+# as large as the base files, so each operation is rewritten a bounded number of
+# times on average.
+COMPACT_MIN_BATCHES = 16
+
+
+class SyncError(Exception):
+    """Raised when a peer or sync directory provides malformed data."""
+
+
+def item_digest(text):
+    """Return the content hash used to identify an item across replicas.
+
+    Args:
+        text: The clipboard text content.
+
+    Returns:
+        Hex SHA-256 digest of the UTF-8 encoded text.
+    """
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _is_replica_id(value):
+    """Return True if value is a valid replica id."""
+    return isinstance(value, str) and _REPLICA_ID_RE.fullmatch(value) is not None
+
+
+def _stamp(op):
+    """Return the total-order stamp of an operation."""
+    return (op['clock'], op['origin'])
+
+
+def _validate_op(op):
+    """Check that an operation received from a peer is well formed.
+
+    Args:
+        op: Operation dict.
+
+    Raises:
+        SyncError: If the operation is missing keys or has bad values.
+    """
+    try:
+        valid = (
+            _is_replica_id(op['origin'])
+            and isinstance(op['clock'], int) and op['clock'] > 0
+            and isinstance(op['digest'], str) and _DIGEST_RE.fullmatch(op['digest']) is not None
+            and op['field'] in FIELDS
+            and isinstance(op['value'], str if op['field'] == 'name' else bool)
+        )
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise SyncError(f"Malformed sync operation: {op!r}")
+
+
+class SyncReplica:
+    """Sync state of one Clipman instance.
+
+    Only the winning operation for each (digest, field) pair is kept, so the
+    log grows with the number of distinct items rather than with the number of
+    edits. Removed items are dropped entirely once every known replica has seen
+    the removal (see collect()).
+
+    Attributes:
+        replica_id: Unique id of this replica.
+        clock: Lamport clock, the highest clock seen or issued.
+        vector: Highest clock seen per origin replica id.
+    """
+
+    def __init__(self, replica_id=None):
+        """Initialize an empty replica.
+
+        Args:
+            replica_id: Id of this replica, lowercase hex (default: a new random id).
+
+        Raises:
+            ValueError: If replica_id is not lowercase hex.
+        """
+        self.replica_id = replica_id or uuid.uuid4().hex
+        if not _is_replica_id(self.replica_id):
+            raise ValueError(f"Invalid replica id: {self.replica_id!r}")
+        self.clock = 0
+        self.vector = {}
+        self._log = {}
+        # Bodies of items that are materialized in the local history, by digest
+        self._bodies = {}
+
+    def to_dict(self):
+        """Return the replica state as a JSON-serializable dict.
+
+        Item bodies are not included; they live in the clipboard history and
+        are re-attached by record_local().
+        """
+        return {
+            'replica_id': self.replica_id,
+            'clock': self.clock,
+            'vector': self.vector,
+            'ops': sorted(self._log.values(), key=_stamp),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore a replica saved with to_dict().
+
+        Args:
+            data: Dict produced by to_dict().
+
+        Returns:
+            A SyncReplica instance.
+
+        Raises:
+            SyncError: If the data is malformed.
+        """
+        try:
+            replica = cls(data['replica_id'])
+            replica.clock = int(data['clock'])
+            replica.vector = {origin: int(clock) for origin, clock in data['vector'].items()}
+            ops = data['ops']
+            if not isinstance(ops, list):
+                raise TypeError("ops must be a list")
+            if not all(_is_replica_id(origin) for origin in [replica.replica_id, *replica.vector]):
+                raise ValueError("invalid replica id")
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise SyncError(f"Malformed sync state: {e}")
+        for op in ops:
+            _validate_op(op)
+            replica._log[(op['digest'], op['field'])] = op
+        return replica
+
+    def _value(self, digest, field, default):
+        """Return the current value of a register."""
+        op = self._log.get((digest, field))
+        return op['value'] if op else default
+
+    def _issue(self, digest, field, value):
+        """Record a new local operation."""
+        self.clock += 1
+        op = {
+            'origin': self.replica_id,
+            'clock': self.clock,
+            'digest': digest,
+            'field': field,
+            'value': value,
+        }
+        self._log[(digest, field)] = op
+        self.vector[self.replica_id] = self.clock
+
+    def record_local(self, items):
+        """Record operations for local changes since the last call.
+
+        Compares the local history with the replicated state and issues an
+        operation for every difference. Items that are known to be present but
+        whose body has not been fetched yet are left alone.
+
+        Args:
+            items: Iterable of ClipboardItem objects making up the local history.
+
+        Returns:
+            Number of operations issued.
+        """
+        start = self.clock
+        seen = set()
+        for item in items:
+            digest = item_digest(item.text)
+            seen.add(digest)
+            self._bodies[digest] = item.text
+            added = not self._value(digest, 'present', False)
+            if added:
+                self._issue(digest, 'present', True)
+            # A (re-)added item restates its pin and name, so older operations from
+            # before a removal cannot win on replicas that have not collected them
+            if added or self._value(digest, 'pinned', False) != item.pinned:
+                self._issue(digest, 'pinned', item.pinned)
+            if added or self._value(digest, 'name', '') != item.name:
+                self._issue(digest, 'name', item.name)
+        for digest in list(self._bodies):
+            if digest not in seen:
+                del self._bodies[digest]
+                if self._value(digest, 'present', False):
+                    self._issue(digest, 'present', False)
+        issued = self.clock - start
+        if issued:
+            logger.debug("Recorded %s local sync operation(s)", issued)
+        return issued
+
+    def delta(self, since):
+        """Return the operations not covered by a vector clock.
+
+        Args:
+            since: Vector clock of the receiving side.
+
+        Returns:
+            List of operation dicts in stamp order.
+        """
+        ops = [op for op in self._log.values() if op['clock'] > since.get(op['origin'], 0)]
+        return sorted(ops, key=_stamp)
+
+    def apply(self, ops):
+        """Merge operations received from a peer.
+
+        Args:
+            ops: Iterable of operation dicts.
+
+        Returns:
+            Set of digests whose state changed.
+
+        Raises:
+            SyncError: If an operation is malformed. Nothing is applied in that case.
+        """
+        ops = list(ops)
+        for op in ops:
+            _validate_op(op)
+        changed = set()
+        for op in ops:
+            key = (op['digest'], op['field'])
+            current = self._log.get(key)
+            if current is None or _stamp(op) > _stamp(current):
+                self._log[key] = op
+                changed.add(op['digest'])
+                if op['field'] == 'present' and not op['value']:
+                    self._bodies.pop(op['digest'], None)
+            if op['clock'] > self.vector.get(op['origin'], 0):
+                self.vector[op['origin']] = op['clock']
+            self.clock = max(self.clock, op['clock'])
+        return changed
+
+    def collect(self, stable):
+        """Drop removed items whose operations every known replica has seen.
+
+        Args:
+            stable: Vector clock that every known replica has reached.
+
+        Returns:
+            Number of removed items dropped.
+        """
+        ops_by_digest = {}
+        for (digest, _), op in self._log.items():
+            ops_by_digest.setdefault(digest, []).append(op)
+        collected = 0
+        for digest, ops in ops_by_digest.items():
+            present = self._log.get((digest, 'present'))
+            if present is None or present['value']:
+                continue
+            if all(op['clock'] <= stable.get(op['origin'], 0) for op in ops):
+                for op in ops:
+                    del self._log[(digest, op['field'])]
+                collected += 1
+        if collected:
+            logger.debug("Collected %s removed item(s) seen by every replica", collected)
+        return collected
+
+    def is_winning(self, op):
+        """Return True if op is the current winning operation for its register."""
+        current = self._log.get((op['digest'], op['field']))
+        return current is not None and _stamp(current) == _stamp(op)
+
+    def tracks(self, digest):
+        """Return True if the log holds any operation for an item."""
+        return any((digest, field) in self._log for field in FIELDS)
+
+    def entry(self, digest):
+        """Return the replicated state of an item.
+
+        Args:
+            digest: Item digest.
+
+        Returns:
+            (pinned, name) tuple, or None if the item is not present.
+        """
+        if not self._value(digest, 'present', False):
+            return None
+        return self._value(digest, 'pinned', False), self._value(digest, 'name', '')
+
+    def added_at(self, digest):
+        """Return the stamp of the operation that made an item present."""
+        op = self._log.get((digest, 'present'))
+        return _stamp(op) if op else (0, '')
+
+    def body(self, digest):
+        """Return the text of a locally held item, or None."""
+        return self._bodies.get(digest)
+
+    def add_body(self, digest, text):
+        """Attach a fetched item body.
+
+        Args:
+            digest: Item digest.
+            text: Item text.
+
+        Returns:
+            True if the body was accepted, False if it does not match the digest.
+        """
+        if item_digest(text) != digest:
+            logger.warning("Discarding sync body with mismatched digest %s", digest)
+            return False
+        self._bodies[digest] = text
+        return True
+
+    def missing_bodies(self):
+        """Return digests of present items whose body is not held locally."""
+        return sorted(
+            digest for (digest, field), op in self._log.items()
+            if field == 'present' and op['value'] and digest not in self._bodies
+        )
+
+
+class LocalPeerTransport:
+    """Transport to another SyncReplica in the same process.
+
+    Used to sync two replicas directly, e.g. in tests. Removed items are
+    collected based on the replicas known to a DirectoryTransport, so a replica
+    that syncs this way must also have synced with the shared directory first.
+    """
+
+    def __init__(self, peer):
+        """Initialize the transport.
+
+        Args:
+            peer: The remote SyncReplica.
+        """
+        self.peer = peer
+
+    def vector(self):
+        """Return the peer's vector clock."""
+        return dict(self.peer.vector)
+
+    def pull(self, since):
+        """Return the peer's operations not covered by since."""
+        return self.peer.delta(since)
+
+    def fetch(self, digests):
+        """Return {digest: text} for the requested bodies the peer holds."""
+        bodies = {}
+        for digest in digests:
+            text = self.peer.body(digest)
+            if text is not None:
+                bodies[digest] = text
+        return bodies
+
+    def push(self, ops, body_source):
+        """Send operations to the peer.
+
+        Args:
+            ops: Operation dicts to send.
+            body_source: Callable returning the text for a digest, or None. Only
+                called for bodies the peer is missing.
+        """
+        self.peer.apply(ops)
+        for digest in self.peer.missing_bodies():
+            text = body_source(digest)
+            if text is not None:
+                self.peer.add_body(digest, text)
+
+    def acknowledge(self, replica_id, vector):
+        """Return the vector clock every known replica has reached.
+
+        The peer may know replicas this side does not, so nothing is stable.
+        """
+        return {}
+
+    def compact(self, replica):
+        """Nothing is stored, so there is nothing to compact."""
+        return False
+
+
+class DirectoryTransport:
+    """Transport through a shared directory (network share, synced folder, ...).
+
+    Layout:
+        ops/<origin>/<clock>.json: The operations of one origin replica sent by
+            one push, named after the highest clock in the file.
+        ops/<origin>/<clock>.base.json: Compacted operations of one origin up to
+            clock, holding only operations that were still winning.
+        seen/<replica>.json: Vector clock each replica had reached after its last sync.
+        blobs/<digest>: Item bodies, UTF-8 encoded.
+    """
+
+    def __init__(self, path):
+        """Initialize the transport.
+
+        Args:
+            path: Path of an existing shared directory.
+
+        Raises:
+            SyncError: If the directory does not exist, e.g. an unmounted share.
+        """
+        if not os.path.isdir(path):
+            raise SyncError(f"Sync directory not found: {path}")
+        self.path = path
+        self.ops_dir = os.path.join(path, 'ops')
+        self.seen_dir = os.path.join(path, 'seen')
+        self.blobs_dir = os.path.join(path, 'blobs')
+        os.makedirs(self.ops_dir, exist_ok=True)
+        os.makedirs(self.seen_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+    def _origins(self):
+        """Yield the id of every origin replica with operations in the directory."""
+        for origin in os.listdir(self.ops_dir):
+            if _is_replica_id(origin) and os.path.isdir(os.path.join(self.ops_dir, origin)):
+                yield origin
+
+    def _origin_batches(self, origin):
+        """Return the operation files of one origin, newest first.
+
+        Returns:
+            List of (clock, is_base, path, size) tuples.
+        """
+        batches = []
+        with os.scandir(os.path.join(self.ops_dir, origin)) as entries:
+            for entry in entries:
+                stem, ext = os.path.splitext(entry.name)
+                is_base = stem.endswith('.base')
+                if is_base:
+                    stem = stem[:-len('.base')]
+                if ext == '.json' and stem.isdigit():
+                    try:
+                        size = entry.stat().st_size
+                    except FileNotFoundError:
+                        continue
+                    batches.append((int(stem), is_base, entry.path, size))
+        return sorted(batches, reverse=True)
+
+    def _read_batch(self, origin, path):
+        """Read and validate an operation batch.
+
+        Args:
+            origin: Origin replica id the batch belongs to.
+            path: Path of the batch file.
+
+        Returns:
+            List of operation dicts, or None if the file was removed by a
+            concurrent compaction.
+
+        Raises:
+            SyncError: If the batch is not a valid list of operations from origin.
+        """
+        try:
+            with open(path, 'rb') as f:
+                batch = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            raise SyncError(f"Corrupt sync batch {path}: {e}")
+        if not isinstance(batch, list):
+            raise SyncError(f"Corrupt sync batch {path}: expected a list of operations")
+        for op in batch:
+            _validate_op(op)
+            if op['origin'] != origin:
+                raise SyncError(f"Corrupt sync batch {path}: operation from another origin")
+        return batch
+
+    def _write(self, path, data):
+        """Atomically write bytes to path."""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove(self, path):
+        """Remove a file, ignoring it if already gone."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def vector(self):
+        """Return the highest clock stored per origin."""
+        vector = {}
+        for origin in self._origins():
+            batches = self._origin_batches(origin)
+            if batches:
+                vector[origin] = batches[0][0]
+        return vector
+
+    def pull(self, since):
+        """Return the stored operations not covered by since.
+
+        Only files newer than since are read, so a replica that syncs regularly
+        reads just the batches pushed since its last sync.
+
+        Raises:
+            SyncError: If a batch file is corrupt.
+        """
+        ops = []
+        for origin in self._origins():
+            for _ in range(3):
+                origin_ops = self._pull_origin(origin, since.get(origin, 0))
+                if origin_ops is not None:
+                    break
+            else:
+                raise SyncError(f"Operations of {origin} kept changing during sync, try again")
+            ops.extend(origin_ops)
+        return ops
+
+    def _pull_origin(self, origin, since):
+        """Return the operations of one origin newer than since.
+
+        Returns:
+            List of operation dicts, or None if a file was removed by a concurrent
+            compaction while reading. Its operations are then in a new base file.
+        """
+        ops = []
+        for clock, _, path, _ in self._origin_batches(origin):
+            if clock <= since:
+                break
+            batch = self._read_batch(origin, path)
+            if batch is None:
+                return None
+            ops.extend(op for op in batch if op['clock'] > since)
+        return ops
+
+    def fetch(self, digests):
+        """Return {digest: text} for the requested bodies stored in the directory."""
+        bodies = {}
+        for digest in digests:
+            try:
+                with open(os.path.join(self.blobs_dir, digest), 'rb') as f:
+                    bodies[digest] = f.read().decode('utf-8', 'surrogatepass')
+            except FileNotFoundError:
+                pass
+        return bodies
+
+    def push(self, ops, body_source):
+        """Store operations, the bodies of newly present items, and drop removed bodies.
+
+        Bodies already stored under their digest are not written again. The body
+        of an item whose removal is pushed is deleted from the directory.
+
+        Args:
+            ops: Operation dicts to store.
+            body_source: Callable returning the text for a digest, or None.
+        """
+        batches = {}
+        for op in ops:
+            batches.setdefault(op['origin'], []).append(op)
+            if op['field'] != 'present':
+                continue
+            path = os.path.join(self.blobs_dir, op['digest'])
+            if op['value']:
+                text = body_source(op['digest'])
+                if text is not None and not os.path.exists(path):
+                    self._write(path, text.encode('utf-8', 'surrogatepass'))
+            else:
+                self._remove(path)
+        for origin, batch in batches.items():
+            origin_dir = os.path.join(self.ops_dir, origin)
+            os.makedirs(origin_dir, exist_ok=True)
+            path = os.path.join(origin_dir, f"{batch[-1]['clock']:012d}.json")
+            self._write(path, json.dumps(batch).encode('utf-8'))
+
+    def acknowledge(self, replica_id, vector):
+        """Record how far a replica has synced and return what every replica has seen.
+
+        Args:
+            replica_id: Id of the replica that just synced.
+            vector: Its vector clock.
+
+        Returns:
+            Vector clock that every replica known to the directory has reached.
+            Empty if some replica has operations here but has never synced with
+            the directory itself.
+
+        Raises:
+            SyncError: If a seen file is corrupt.
+        """
+        self._write(os.path.join(self.seen_dir, f"{replica_id}.json"), json.dumps(vector).encode('utf-8'))
+        stable = dict(vector)
+        known = {replica_id}
+        for filename in os.listdir(self.seen_dir):
+            other_id, ext = os.path.splitext(filename)
+            if ext != '.json' or not _is_replica_id(other_id) or other_id == replica_id:
+                continue
+            known.add(other_id)
+            path = os.path.join(self.seen_dir, filename)
+            try:
+                with open(path, 'rb') as f:
+                    seen = json.loads(f.read().decode('utf-8'))
+            except FileNotFoundError:
+                continue
+            except ValueError as e:
+                raise SyncError(f"Corrupt seen file {path}: {e}")
+            if not isinstance(seen, dict) or not all(isinstance(clock, int) for clock in seen.values()):
+                raise SyncError(f"Corrupt seen file {path}: expected a vector clock")
+            stable = {origin: min(clock, seen.get(origin, 0)) for origin, clock in stable.items()}
+        if any(origin not in known for origin in self._origins()):
+            return {}
+        return stable
+
+    def compact(self, replica):
+        """Fold each origin's batches into a single base file when they have grown.
+
+        Merged operations are checked against the replica's log, which holds the
+        winning operations for everything it has pulled, so superseded operations
+        and removed items it has collected are dropped. Only files the replica has
+        fully seen are merged, and the newest file of each origin is kept.
+
+        Args:
+            replica: A SyncReplica that has just synced with this directory.
+
+        Returns:
+            True if the directory was compacted.
+        """
+        files = {origin: self._origin_batches(origin) for origin in self._origins()}
+        batch_sizes = [size for batches in files.values() for _, is_base, _, size in batches if not is_base]
+        base_size = sum(size for batches in files.values() for _, is_base, _, size in batches if is_base)
+        if len(batch_sizes) < COMPACT_MIN_BATCHES or sum(batch_sizes) < base_size:
+            return False
+
+        # The newest file of each origin is left alone so replicas one push behind
+        # do not reread the base. Only files the replica has fully seen are merged.
+        merged, kept_digests = {}, set()
+        for origin, batches in files.items():
+            for index, (clock, _, path, _) in enumerate(batches):
+                batch = self._read_batch(origin, path)
+                if batch is None:
+                    # Another replica is compacting
+                    return False
+                if index > 0 and clock <= replica.vector.get(origin, 0):
+                    merged.setdefault(origin, []).append((clock, path, batch))
+                else:
+                    kept_digests.update(op['digest'] for op in batch)
+
+        for origin, batches in merged.items():
+            top = batches[0][0]
+            # Superseded operations are dropped. Operations of items the replica has
+            # collected are dropped too, unless a kept file still mentions the item.
+            base = {}
+            for _, _, batch in batches:
+                for op in batch:
+                    if replica.is_winning(op) or (
+                        not replica.tracks(op['digest']) and op['digest'] in kept_digests
+                    ):
+                        base[(op['digest'], op['field'], op['clock'])] = op
+            path = os.path.join(self.ops_dir, origin, f"{top:012d}.base.json")
+            self._write(path, json.dumps(sorted(base.values(), key=_stamp)).encode('utf-8'))
+            for _, old_path, _ in batches:
+                if old_path != path:
+                    self._remove(old_path)
+        logger.info("Compacted sync directory (%s batch file(s) folded)", len(batch_sizes))
+        return True
+
+
+def sync(replica, transport, on_change=None):
+    """Exchange deltas between a replica and a transport.
+
+    Call replica.record_local() first so local changes are included.
+
+    Args:
+        replica: The local SyncReplica.
+        transport: A LocalPeerTransport, DirectoryTransport or compatible object.
+        on_change: Optional callable receiving the changed digests as soon as the
+            incoming changes are merged, before anything is sent. The local
+            history must be updated from it: if the sync fails afterwards, the
+            next record_local() would otherwise report the merged remote state
+            as local changes.
+
+    Returns:
+        Digests whose local state changed, ordered by when the item was added.
+
+    Raises:
+        SyncError: If the peer provides malformed data.
+        OSError: If the transport cannot be read or written.
+    """
+    incoming = transport.pull(replica.vector)
+    changed = replica.apply(incoming)
+
+    missing = replica.missing_bodies()
+    try:
+        if missing:
+            for digest, text in transport.fetch(missing).items():
+                if digest in missing and replica.add_body(digest, text):
+                    changed.add(digest)
+    finally:
+        changed = sorted(changed, key=replica.added_at)
+        if on_change is not None:
+            on_change(changed)
+
+    outgoing = replica.delta(transport.vector())
+    transport.push(outgoing, replica.body)
+    replica.collect(transport.acknowledge(replica.replica_id, replica.vector))
+    transport.compact(replica)
+
+    logger.info(
+        "Sync complete: received %s op(s), sent %s op(s), fetched %s of %s missing bodies",
+        len(incoming), len(outgoing), len(missing) - len(replica.missing_bodies()), len(missing),
+    )
+    return changed
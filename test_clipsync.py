@@ -0,0 +1,292 @@
+import json
+import os
+
+import pytest
+
+import clipsync
+from clipsync import DirectoryTransport, LocalPeerTransport, SyncError, SyncReplica, item_digest, sync
+
+
+class Item:
+    """Stand-in for ClipboardItem, which needs the GUI dependencies to import."""
+
+    def __init__(self, text, pinned=False, name=''):
+        self.text = text
+        self.pinned = pinned
+        self.name = name
+
+
+def state(replica, texts):
+    return {text: replica.entry(item_digest(text)) for text in texts}
+
+
+def history_updater(replica, items):
+    """Return an on_change callback that updates items like ClipboardManager does."""
+
+    def apply_changes(changed):
+        by_digest = {item_digest(item.text): item for item in items}
+        for digest in changed:
+            item, entry = by_digest.get(digest), replica.entry(digest)
+            if entry is None:
+                if item is not None:
+                    items.remove(item)
+            elif item is None:
+                if replica.body(digest) is not None:
+                    items.append(Item(replica.body(digest), *entry))
+            else:
+                item.pinned, item.name = entry
+
+    return apply_changes
+
+
+def test_local_peer_converges_with_last_writer_wins():
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a_items = [Item('one'), Item('two')]
+    a.record_local(a_items)
+    sync(b, LocalPeerTransport(a))
+    assert b.missing_bodies() == []
+    b_items = [Item('one'), Item('two')]
+    b.record_local(b_items)
+
+    # Concurrent edits of the same item: equal clocks, so the higher replica id wins
+    a_items[0].name = 'from a'
+    b_items[0].name = 'from b'
+    a.record_local(a_items)
+    b.record_local(b_items)
+    # A later edit wins regardless of replica id
+    a_items[1].pinned = True
+    a.record_local(a_items)
+    sync(a, LocalPeerTransport(b))
+
+    assert state(a, ['one', 'two']) == state(b, ['one', 'two'])
+    assert a.entry(item_digest('one')) == (False, 'from b')
+    assert a.entry(item_digest('two')) == (True, '')
+
+
+def test_remote_removal_propagates():
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a_items = [Item('keep'), Item('secret')]
+    a.record_local(a_items)
+    sync(b, LocalPeerTransport(a))
+
+    a.record_local(a_items[:1])
+    changed = sync(b, LocalPeerTransport(a))
+
+    assert changed == [item_digest('secret')]
+    assert b.entry(item_digest('secret')) is None
+    assert b.body(item_digest('secret')) is None
+    assert b.entry(item_digest('keep')) == (False, '')
+
+
+def test_directory_sync_sends_only_changes(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a.record_local([Item('shared'), Item('only a')])
+    sync(a, transport)
+    b.record_local([Item('shared')])
+    sync(b, transport)
+    assert b.body(item_digest('only a')) == 'only a'
+
+    # Nothing changed: no operations either way and no bodies fetched
+    assert transport.pull(b.vector) == []
+    assert b.delta(transport.vector()) == []
+    assert b.missing_bodies() == []
+
+    fetched = []
+    original_fetch = transport.fetch
+    transport.fetch = lambda digests: fetched.append(list(digests)) or original_fetch(digests)
+    a.record_local([Item('shared'), Item('only a'), Item('new')])
+    sync(a, transport)
+    sync(b, transport)
+    assert fetched == [[item_digest('new')]]
+
+
+def test_failed_push_does_not_revert_remote_changes(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a_items, b_items = [Item('x'), Item('y')], []
+    a.record_local(a_items)
+    sync(a, transport)
+    sync(b, transport, on_change=history_updater(b, b_items))
+
+    a_items[1].pinned = True
+    del a_items[0]
+    a.record_local(a_items)
+    sync(a, transport)
+
+    b_items.append(Item('z'))
+    b.record_local(b_items)
+    failing = DirectoryTransport(str(tmp_path))
+
+    def push(ops, body_source):
+        raise OSError("share went away")
+
+    failing.push = push
+    with pytest.raises(OSError):
+        sync(b, failing, on_change=history_updater(b, b_items))
+
+    # The history caught up with the replica, so nothing is reported as a local change
+    assert [item.text for item in b_items] == ['y', 'z']
+    assert b.record_local(b_items) == 0
+
+    sync(b, transport, on_change=history_updater(b, b_items))
+    sync(a, transport, on_change=history_updater(a, a_items))
+    assert state(a, ['x', 'y', 'z']) == state(b, ['x', 'y', 'z']) == {
+        'x': None, 'y': (True, ''), 'z': (False, ''),
+    }
+
+
+def test_directory_deletes_removed_bodies(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    a = SyncReplica('a')
+    items = [Item(str(i)) for i in range(5)]
+    for i in range(len(items)):
+        a.record_local(items[:i + 1])
+        sync(a, transport)
+    assert len(os.listdir(tmp_path / 'blobs')) == 5
+
+    a.record_local([])
+    sync(a, transport)
+    assert os.listdir(tmp_path / 'blobs') == []
+
+
+def test_directory_pull_reads_only_new_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(clipsync, 'COMPACT_MIN_BATCHES', 4)
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    read = []
+    original_read_batch = transport._read_batch
+    transport._read_batch = lambda origin, path: read.append(path) or original_read_batch(origin, path)
+
+    items = []
+    for i in range(20):
+        items.append(Item(str(i)))
+        a.record_local(items)
+        sync(a, transport)
+        read.clear()
+        sync(b, transport)
+        assert len(read) == 1
+        assert b.entry(item_digest(str(i))) == (False, '')
+
+    filenames = os.listdir(tmp_path / 'ops' / 'a')
+    assert len(filenames) < len(items)
+    assert any(filename.endswith('.base.json') for filename in filenames)
+    c = SyncReplica('c')
+    sync(c, transport)
+    assert state(c, [item.text for item in items]) == state(a, [item.text for item in items])
+
+
+def test_directory_collects_removals_seen_by_every_replica(tmp_path, monkeypatch):
+    monkeypatch.setattr(clipsync, 'COMPACT_MIN_BATCHES', 2)
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a_items, b_items = [Item('secret'), Item('keep')], []
+    a.record_local(a_items)
+    sync(a, transport)
+    sync(b, transport, on_change=history_updater(b, b_items))
+
+    del a_items[0]
+    for i in range(4):
+        a.record_local(a_items)
+        sync(a, transport, on_change=history_updater(a, a_items))
+        sync(b, transport, on_change=history_updater(b, b_items))
+        a_items.append(Item(f'new {i}'))
+
+    secret = item_digest('secret')
+    assert secret not in json.dumps(a.to_dict())
+    assert secret not in json.dumps(b.to_dict())
+    for filename in os.listdir(tmp_path / 'ops' / 'a'):
+        assert secret not in (tmp_path / 'ops' / 'a' / filename).read_text()
+
+    c = SyncReplica('c')
+    sync(c, transport)
+    assert c.entry(secret) is None
+    assert c.entry(item_digest('keep')) == (False, '')
+
+
+def test_readded_item_restates_pin_and_name(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a.record_local([Item('x', True, 'old')])
+    sync(a, transport)
+    sync(b, transport)
+    a.record_local([])
+    sync(a, transport)
+    sync(b, transport)
+    sync(a, transport)
+    assert not a.tracks(item_digest('x'))
+
+    # The old pin and name are still in the directory, but the re-add wins
+    a.record_local([Item('x')])
+    sync(a, transport)
+    c = SyncReplica('c')
+    sync(c, transport)
+    sync(b, transport)
+    assert c.entry(item_digest('x')) == b.entry(item_digest('x')) == (False, '')
+
+
+def test_directory_waits_for_unsynced_replicas_before_collecting(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    a, b = SyncReplica('a'), SyncReplica('b')
+    a.record_local([Item('secret')])
+    sync(a, transport)
+    sync(b, transport)
+
+    a.record_local([])
+    sync(a, transport)
+    sync(a, transport)
+    # b has not seen the removal yet
+    assert a.to_dict()['ops'] != []
+    sync(b, transport)
+    sync(a, transport)
+    assert a.to_dict()['ops'] == []
+    assert b.entry(item_digest('secret')) is None
+
+
+def test_missing_directory_raises(tmp_path):
+    with pytest.raises(SyncError):
+        DirectoryTransport(str(tmp_path / 'unmounted'))
+
+
+def test_corrupt_batch_raises(tmp_path):
+    transport = DirectoryTransport(str(tmp_path))
+    os.makedirs(tmp_path / 'ops' / 'a')
+    (tmp_path / 'ops' / 'a' / '000000000001.json').write_text('{not json')
+    with pytest.raises(SyncError):
+        sync(SyncReplica('b'), transport)
+
+
+@pytest.mark.parametrize('op', [
+    {'origin': '../../x', 'clock': 1, 'digest': item_digest('x'), 'field': 'pinned', 'value': True},
+    {'origin': 'a', 'clock': 1, 'digest': '../x', 'field': 'pinned', 'value': True},
+    {'origin': 'a', 'clock': 0, 'digest': item_digest('x'), 'field': 'pinned', 'value': True},
+    {'origin': 'a', 'clock': 1, 'digest': item_digest('x'), 'field': 'name', 'value': True},
+])
+def test_corrupt_op_raises(tmp_path, op):
+    with pytest.raises(SyncError):
+        SyncReplica('b').apply([op])
+
+    transport = DirectoryTransport(str(tmp_path))
+    os.makedirs(tmp_path / 'ops' / 'a')
+    (tmp_path / 'ops' / 'a' / '000000000001.json').write_text(json.dumps([op]))
+    with pytest.raises(SyncError):
+        sync(SyncReplica('b'), transport)
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'replica_id': 'a', 'clock': 1, 'vector': {}, 'ops': 5},
+    {'replica_id': '../a', 'clock': 1, 'vector': {}, 'ops': []},
+])
+def test_malformed_state_raises(data):
+    with pytest.raises(SyncError):
+        SyncReplica.from_dict(data)
+
+
+def test_state_round_trip():
+    a = SyncReplica('a')
+    a.record_local([Item('one', True, 'name')])
+    restored = SyncReplica.from_dict(json.loads(json.dumps(a.to_dict())))
+    restored.record_local([Item('one', True, 'name')])
+    assert restored.clock == a.clock
+    assert restored.entry(item_digest('one')) == (True, 'name')